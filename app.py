@@ -1,142 +1,547 @@
 import streamlit as st
-import pdfplumber
-import pytesseract
-from pdf2image import convert_from_bytes
+from streamlit.runtime.uploaded_file_manager import UploadedFile
 import json
-import openai
 from dotenv import load_dotenv
 import os
-from jinja2 import Template
-import weasyprint
+from jinja2 import Environment, FileSystemLoader, TemplateNotFound
 import tempfile
 from datetime import datetime
 import re
+import hashlib
+import base64
+import io
+import threading
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# PDF, OCR and API libraries (pdfplumber, pytesseract, pdf2image, weasyprint,
+# openai) are imported inside the functions that use them, so the first page
+# render doesn't pay for loading them
 
 # Load environment variables
 load_dotenv()
 
-def get_openai_client():
-    """Get OpenAI client with API key from secrets or environment"""
+# Directory containing app.py, logo.png and templates/
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+LOGO_PATH = os.path.join(BASE_DIR, 'logo.png')
+
+# Number of pages OCR'd in parallel (each page runs its own tesseract process)
+OCR_WORKERS = os.cpu_count() or 1
+# Rasterization resolution for OCR; 150 DPI is plenty for printed voucher text
+OCR_DPI = 150
+# LSTM engine only, single uniform text block (skips orientation/layout detection)
+OCR_CONFIG = '--oem 1 --psm 6'
+OCR_LANG = 'eng'
+# Seconds tesseract may spend on a single page before giving up
+OCR_PAGE_TIMEOUT = 60
+# Seconds pdfplumber gets to finish on its own before OCR is started alongside it
+PDFPLUMBER_HEAD_START = 2.0
+# Pages read with pdfplumber or OCR; vouchers rarely have useful text beyond these
+MAX_TEXT_PAGES = 10
+
+# OpenAI model used for field extraction
+OPENAI_MODEL = "gpt-4o-mini"
+# Bump whenever the extraction prompt changes so cached results are invalidated
+PROMPT_VERSION = "3"
+
+# JSON schema enforced on the OpenAI response (structured outputs)
+_STRING = {"type": "string"}
+VOUCHER_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "hotel_name": _STRING,
+        "hotel_address": _STRING,
+        "hotel_contact": _STRING,
+        "confirmation_number": _STRING,
+        "city": _STRING,
+        "country": _STRING,
+        "lead_guest_name": _STRING,
+        "guest_nationality": _STRING,
+        "num_guests": _STRING,
+        "check_in_date": _STRING,
+        "check_out_date": _STRING,
+        "num_nights": _STRING,
+        "rooms": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "room_category": _STRING,
+                    "bed_type": _STRING,
+                    "breakfast_included": _STRING,
+                    "guest_names": {"type": "array", "items": _STRING},
+                    "adults": {"type": "integer"},
+                    "children": {"type": "integer"}
+                },
+                "required": [
+                    "room_category", "bed_type", "breakfast_included",
+                    "guest_names", "adults", "children"
+                ],
+                "additionalProperties": False
+            }
+        },
+        "special_requests": _STRING,
+        "additional_information": {"type": "array", "items": _STRING}
+    },
+    "required": [
+        "hotel_name", "hotel_address", "hotel_contact", "confirmation_number",
+        "city", "country", "lead_guest_name", "guest_nationality", "num_guests",
+        "check_in_date", "check_out_date", "num_nights", "rooms",
+        "special_requests", "additional_information"
+    ],
+    "additionalProperties": False
+}
+# Batched vouchers also carry the "Voucher N" number they were extracted from,
+# so results can be matched back to files without trusting their order
+VOUCHER_BATCH_ITEM_SCHEMA = {
+    **VOUCHER_SCHEMA,
+    "properties": {"voucher_number": {"type": "integer"}, **VOUCHER_SCHEMA["properties"]},
+    "required": ["voucher_number", *VOUCHER_SCHEMA["required"]]
+}
+# Structured outputs require an object at the top level, so batches are wrapped
+VOUCHER_BATCH_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "vouchers": {"type": "array", "items": VOUCHER_BATCH_ITEM_SCHEMA}
+    },
+    "required": ["vouchers"],
+    "additionalProperties": False
+}
+
+# Fixed extraction instructions, sent as the system message so the prefix is
+# identical on every call (and eligible for OpenAI prompt caching). The field
+# list itself is enforced by VOUCHER_SCHEMA via response_format.
+SYSTEM_PROMPT = """Extract hotel voucher information from the text provided by the user as JSON.
+
+Instructions:
+- For confirmation_number: ONLY extract if you find explicit terms like "Hotel Confirmation Number", "Hotel Conf Number", "HCN", "Hotel Confirmation", "Confirmation Code", or "Hotel Reference Number". If you only find booking IDs, reference numbers, or other generic IDs (like "REZ68272DD2"), use "To be confirmed" instead
+- Use "Bed type assigned at check-in" for bed_type if not specified
+- For breakfast_included, use "Yes", "No", or "Not specified"
+- Leave hotel_address and hotel_contact blank if not in document
+- Extract all guest names if multiple are present
+- Calculate num_nights from check-in and check-out dates if not explicitly stated
+- For additional_information, extract important details as an array of strings including:
+  * Check-in/Check-out policies and specific timings
+  * Mandatory fees (deposits, destination fees, resort fees, etc.)
+  * Optional services and their costs (parking, breakfast, etc.)
+  * Age requirements and restrictions
+  * Pet policies and fees
+  * Special booking conditions and policies
+  * Important notes about the property or booking
+  * Any other relevant information guests should know
+- Exclude generic boilerplate text and agent disclaimers
+- Format each item as a clear, concise bullet point
+"""
+
+# System message used when several vouchers are sent in one request
+BATCH_SYSTEM_PROMPT = SYSTEM_PROMPT + """
+The user message contains several vouchers, each introduced by a "Voucher N:" heading and separated by "---".
+Return one object per voucher in the "vouchers" array, in the same order as they appear,
+and set "voucher_number" to N from that voucher's "Voucher N:" heading.
+"""
+# Rough upper bound on voucher text tokens sent in a single batched request
+MAX_BATCH_INPUT_TOKENS = 50000
+# Vouchers per batched request, so the combined reply stays well within the
+# model's output token limit
+MAX_BATCH_VOUCHERS = 5
+# Approximate characters per token, used to estimate batch size
+CHARS_PER_TOKEN = 4
+# Send several vouchers per request; when False each voucher gets its own
+# request, issued concurrently
+BATCH_PROMPTING = True
+# Maximum number of concurrent OpenAI requests when extracting vouchers one by one
+OPENAI_CONCURRENCY = 8
+# Retries (with exponential backoff) on rate limits and transient API errors
+OPENAI_MAX_RETRIES = 5
+# Connection pool of the shared OpenAI client; it serves every session in the
+# process, so it is sized for the whole server (httpx default) rather than
+# per-session concurrency, with idle connections kept alive for reuse
+OPENAI_MAX_CONNECTIONS = 100
+OPENAI_KEEPALIVE_CONNECTIONS = 20
+
+# Voucher HTML template and its print stylesheet
+TEMPLATES_DIR = os.path.join(BASE_DIR, 'templates')
+TEMPLATE_NAME = 'voucher_template.html'
+STYLESHEET_NAME = 'voucher_template.css'
+# The shared FontConfiguration wraps a Pango font map, which is not thread-safe,
+# so renders from concurrent sessions are serialized
+PDF_RENDER_LOCK = threading.Lock()
+# External stylesheet links; styles are supplied via get_voucher_stylesheets()
+# instead, so WeasyPrint never fetches and parses linked bundles per render
+STYLESHEET_LINK_RE = re.compile(r'<link\b[^>]*\brel=["\']?stylesheet["\']?[^>]*>', re.IGNORECASE)
+
+# Prefix of the voucher data embedded in generated PDFs (PDF Subject metadata)
+STANDARDIZED_VOUCHER_MARKER = 'crh-voucher-v1:'
+
+# Markdown code fences some models wrap around JSON replies
+JSON_FENCE_RE = re.compile(r'^\s*```(?:json)?\s*|\s*```\s*$', re.IGNORECASE)
+
+# Leading/trailing whitespace and bullet characters on additional information items
+BULLET_RE = re.compile(r'^[\s•\-]+|[\s•\-]+$')
+
+# In-memory cache of extracted PDF text: number of PDFs kept and for how long
+TEXT_CACHE_MAX_ENTRIES = 50
+TEXT_CACHE_TTL = 3600
+
+# On-disk cache of extracted fields, shared across sessions. Entries hold guest
+# data, so the directory is private to this user and entries expire.
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'voucher_cache')
+CACHE_MAX_AGE = 7 * 24 * 3600
+
+def sha256_hexdigest(data):
+    """Return the SHA-256 hex digest of bytes or text"""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+def load_cached_json(key):
+    """Load a cached JSON result, or None if missing, expired or unreadable"""
+    path = os.path.join(CACHE_DIR, f"{key}.json")
+    try:
+        if os.path.getmtime(path) < time.time() - CACHE_MAX_AGE:
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def prune_json_cache():
+    """Delete on-disk cache entries older than CACHE_MAX_AGE"""
+    cutoff = time.time() - CACHE_MAX_AGE
+    for entry in os.scandir(CACHE_DIR):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+def store_cached_json(key, data):
+    """Persist a JSON result to the on-disk cache (best effort)"""
+    try:
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        os.chmod(CACHE_DIR, 0o700)
+        prune_json_cache()
+        # mkstemp creates the file readable by this user only
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, os.path.join(CACHE_DIR, f"{key}.json"))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    except OSError:
+        pass
+
+@st.cache_resource
+def create_openai_client(api_key):
+    """Create one OpenAI client per API key so its connection pool is reused across reruns"""
+    import httpx
+    import openai
+    
+    return openai.OpenAI(
+        api_key=api_key,
+        http_client=openai.DefaultHttpxClient(
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_KEEPALIVE_CONNECTIONS
+            )
+        )
+    )
+
+@st.cache_resource
+def find_openai_api_key():
+    """Look up the OpenAI API key from secrets or environment once it exists
+    
+    Raises LookupError when no key is configured; exceptions aren't cached,
+    so a key added later is picked up on the next rerun.
+    """
     try:
         api_key = st.secrets["OPENAI_API_KEY"]
-    except:
+    except Exception:
         api_key = os.getenv('OPENAI_API_KEY')
+    if not api_key:
+        raise LookupError("OPENAI_API_KEY is not configured")
+    return api_key
+
+def get_openai_api_key():
+    """Get the OpenAI API key, or None if it isn't configured"""
+    try:
+        return find_openai_api_key()
+    except LookupError:
+        return None
+
+def get_openai_client():
+    """Get OpenAI client with API key from secrets or environment"""
+    api_key = get_openai_api_key()
     
     if not api_key:
         return None, None
     
-    return openai.OpenAI(api_key=api_key), api_key
+    return create_openai_client(api_key), api_key
 
-def extract_text_from_pdf(pdf_file):
-    """Extract text from PDF using pdfplumber first, then OCR as fallback"""
+def ocr_pdf_page(pdf_path, page_number, cancel_event=None):
+    """Rasterize a single PDF page and run OCR on it
+    
+    Returns None if tesseract timed out on the page.
+    """
+    import pytesseract
+    from pdf2image import convert_from_path
+    
+    if cancel_event is not None and cancel_event.is_set():
+        return ""
+    image = convert_from_path(
+        pdf_path, dpi=OCR_DPI, first_page=page_number, last_page=page_number,
+        grayscale=True, fmt='pgm'
+    )[0]
+    try:
+        # pdfplumber may have found text while this page was rasterizing
+        if cancel_event is not None and cancel_event.is_set():
+            return ""
+        return pytesseract.image_to_string(
+            image, lang=OCR_LANG, config=OCR_CONFIG, timeout=OCR_PAGE_TIMEOUT
+        )
+    except RuntimeError as e:
+        # A timeout only loses this page; real tesseract failures still propagate
+        if isinstance(e, pytesseract.TesseractError):
+            raise
+        return None
+    finally:
+        image.close()
+
+def read_pdf_bytes(pdf_file):
+    """Read an uploaded PDF into bytes once without exhausting the stream"""
+    if hasattr(pdf_file, 'getvalue'):
+        return pdf_file.getvalue()
+    pdf_bytes = pdf_file.read()
+    pdf_file.seek(0)
+    return pdf_bytes
+
+def encode_voucher_metadata(voucher_data):
+    """Serialize voucher data for embedding in a generated PDF's metadata"""
+    payload = json.dumps(voucher_data, separators=(',', ':')).encode('utf-8')
+    return STANDARDIZED_VOUCHER_MARKER + base64.b64encode(payload).decode('ascii')
+
+def matches_schema(value, schema):
+    """Check a decoded JSON value against the JSON Schema subset used by VOUCHER_SCHEMA"""
+    schema_type = schema["type"]
+    if schema_type == "string":
+        return isinstance(value, str)
+    if schema_type == "integer":
+        return isinstance(value, int) and not isinstance(value, bool)
+    if schema_type == "array":
+        return isinstance(value, list) and all(
+            matches_schema(item, schema["items"]) for item in value
+        )
+    if schema_type == "object":
+        return (
+            isinstance(value, dict)
+            and set(value) == set(schema["properties"])
+            and all(matches_schema(value[key], sub) for key, sub in schema["properties"].items())
+        )
+    return False
+
+def decode_voucher_metadata(metadata):
+    """Return voucher data embedded by generate_pdf_voucher, or None for other PDFs"""
+    subject = metadata.get('Subject')
+    if isinstance(subject, bytes):
+        subject = subject.decode('latin-1')
+    if not isinstance(subject, str) or not subject.startswith(STANDARDIZED_VOUCHER_MARKER):
+        return None
+    try:
+        voucher_data = json.loads(base64.b64decode(subject[len(STANDARDIZED_VOUCHER_MARKER):]))
+    except ValueError:
+        return None
+    # Metadata is user-editable; anything that doesn't match our own payload
+    # exactly goes through normal extraction
+    if not matches_schema(voucher_data, VOUCHER_SCHEMA):
+        return None
+    return voucher_data
+
+def extract_text_with_pdfplumber(pdf_bytes):
+    """Extract embedded text and document metadata from PDF bytes using pdfplumber
+    
+    Returns (text, metadata, num_pages); only the first MAX_TEXT_PAGES pages are read.
+    """
+    import pdfplumber
+    
     text = ""
+    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+        metadata = pdf.metadata
+        num_pages = len(pdf.pages)
+        for page in pdf.pages[:MAX_TEXT_PAGES]:
+            page_text = page.extract_text()
+            if page_text:
+                text += page_text + "\n"
+            # Release the page's parsed objects so memory stays at one page
+            page.close()
+    return text, metadata, num_pages
+
+def extract_text_with_ocr(pdf_bytes, cancel_event=None):
+    """Extract text from PDF bytes using OCR on each rasterized page
+    
+    Returns (text, num_pages, timed_out_pages); only the first MAX_TEXT_PAGES
+    pages are read.
+    """
+    from pdf2image import pdfinfo_from_path
+    
+    # Write the PDF to disk once for poppler; convert_from_bytes would make a
+    # fresh temp copy for every page
+    with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp:
+        tmp.write(pdf_bytes)
+        pdf_path = tmp.name
     
-    # Try pdfplumber first
     try:
-        with pdfplumber.open(pdf_file) as pdf:
-            for page in pdf.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    text += page_text + "\n"
-    except Exception as e:
-        st.error(f"Error with pdfplumber: {e}")
+        num_pages = pdfinfo_from_path(pdf_path)["Pages"]
+        
+        # Rasterize and OCR page by page so only one image per worker
+        # is held in memory at a time
+        with ThreadPoolExecutor(max_workers=OCR_WORKERS) as executor:
+            page_texts = list(executor.map(
+                lambda page_number: ocr_pdf_page(pdf_path, page_number, cancel_event),
+                range(1, min(num_pages, MAX_TEXT_PAGES) + 1)
+            ))
+    finally:
+        remove_file(pdf_path)
+    
+    timed_out_pages = [n for n, page_text in enumerate(page_texts, start=1) if page_text is None]
+    text = "\n".join(page_text for page_text in page_texts if page_text is not None)
+    return text, num_pages, timed_out_pages
+
+class TextExtractionError(Exception):
+    """Text extraction hit errors; carries the partial result so it isn't cached
+    
+    messages is a list of (level, message) pairs, level being "error" or "warning".
+    """
     
-    # If no text extracted, try OCR
-    if not text.strip():
-        st.info("No text found with pdfplumber, trying OCR...")
+    def __init__(self, messages, text, voucher_data):
+        super().__init__("; ".join(message for _, message in messages))
+        self.messages = messages
+        self.text = text
+        self.voucher_data = voucher_data
+
+@st.cache_data(
+    show_spinner=False,
+    max_entries=TEXT_CACHE_MAX_ENTRIES,
+    ttl=TEXT_CACHE_TTL,
+    hash_funcs={UploadedFile: lambda f: sha256_hexdigest(f.getvalue())}
+)
+def extract_text_from_pdf_cached(pdf_file):
+    """Cached text extraction; raises TextExtractionError instead of caching failures"""
+    text = ""
+    voucher_data = None
+    num_pages = 0
+    errors = []
+    pdf_bytes = read_pdf_bytes(pdf_file)
+    
+    # Give pdfplumber a head start; only if it is still running afterwards is
+    # OCR started alongside it, and OCR is cancelled if pdfplumber finds text
+    cancel_ocr = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=2)
+    plumber_future = executor.submit(extract_text_with_pdfplumber, pdf_bytes)
+    ocr_future = None
+    if not wait([plumber_future], timeout=PDFPLUMBER_HEAD_START).done:
+        ocr_future = executor.submit(extract_text_with_ocr, pdf_bytes, cancel_ocr)
+    
+    try:
         try:
-            # Convert PDF to images
-            images = convert_from_bytes(pdf_file.read())
-            
-            for i, image in enumerate(images):
-                # Extract text using OCR
-                page_text = pytesseract.image_to_string(image)
-                text += page_text + "\n"
-                
+            text, metadata, num_pages = plumber_future.result()
+            # Re-uploaded standardized vouchers carry their own fields
+            voucher_data = decode_voucher_metadata(metadata)
         except Exception as e:
-            st.error(f"Error with OCR: {e}")
+            errors.append(("error", f"Error with pdfplumber: {e}"))
+        
+        # If no text extracted, use OCR
+        if text.strip():
+            cancel_ocr.set()
+        else:
+            st.info("No text found with pdfplumber, trying OCR...")
+            if ocr_future is None:
+                ocr_future = executor.submit(extract_text_with_ocr, pdf_bytes, cancel_ocr)
+            try:
+                text, num_pages, timed_out_pages = ocr_future.result()
+                if timed_out_pages:
+                    errors.append(("warning", (
+                        f"OCR timed out on page(s) {', '.join(map(str, timed_out_pages))}; "
+                        "their text is missing. Try extracting again."
+                    )))
+            except Exception as e:
+                errors.append(("error", f"Error with OCR: {e}"))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    if num_pages > MAX_TEXT_PAGES:
+        st.info(f"Only the first {MAX_TEXT_PAGES} of {num_pages} pages were read.")
     
-    return text.strip()
+    if errors:
+        raise TextExtractionError(errors, text.strip(), voucher_data)
+    return text.strip(), voucher_data
+
+def extract_text_from_pdf(pdf_file):
+    """Extract text from PDF using pdfplumber first, then OCR as fallback
+    
+    Returns (text, voucher_data), where voucher_data is the data embedded in
+    vouchers previously generated by this app and None for any other PDF.
+    Only error-free extractions are cached, so a failed one is retried next time.
+    """
+    try:
+        return extract_text_from_pdf_cached(pdf_file)
+    except TextExtractionError as e:
+        for level, message in e.messages:
+            getattr(st, level)(message)
+        return e.text, e.voucher_data
+
+def parse_json_response(content):
+    """Parse a model reply as JSON, tolerating surrounding markdown fences"""
+    return json.loads(JSON_FENCE_RE.sub('', content))
+
+def voucher_cache_key(text):
+    """Cache key for the fields extracted from a voucher's text"""
+    return sha256_hexdigest(f"{OPENAI_MODEL}\n{PROMPT_VERSION}\n{text}")
+
+def voucher_request_params(text):
+    """Chat completion parameters for extracting a single voucher"""
+    return {
+        "model": OPENAI_MODEL,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": text}
+        ],
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "voucher",
+                "schema": VOUCHER_SCHEMA,
+                "strict": True
+            }
+        },
+        "temperature": 0
+    }
 
 def extract_voucher_data(text):
     """Use OpenAI to extract structured data from voucher text"""
     
+    # Reuse a previous result for identical text, model and prompt
+    cache_key = voucher_cache_key(text)
+    cached = load_cached_json(cache_key)
+    if cached is not None:
+        return cached
+    
     client, api_key = get_openai_client()
     if not client:
         st.error("OpenAI API key not found. Please check your configuration.")
         return None
     
-    prompt = """
-    Extract hotel voucher information from the following text and return it as JSON with these exact fields:
-
-    {
-        "hotel_name": "",
-        "hotel_address": "",
-        "hotel_contact": "",
-        "confirmation_number": "",
-        "city": "",
-        "country": "",
-        "lead_guest_name": "",
-        "guest_nationality": "",
-        "num_guests": "",
-        "check_in_date": "",
-        "check_out_date": "",
-        "num_nights": "",
-        "rooms": [
-            {
-                "room_category": "",
-                "bed_type": "",
-                "breakfast_included": "",
-                "guest_names": [],
-                "adults": 0,
-                "children": 0
-            }
-        ],
-        "special_requests": "",
-        "additional_information": []
-    }
-
-    Instructions:
-    - For confirmation_number: ONLY extract if you find explicit terms like "Hotel Confirmation Number", "Hotel Conf Number", "HCN", "Hotel Confirmation", "Confirmation Code", or "Hotel Reference Number". If you only find booking IDs, reference numbers, or other generic IDs (like "REZ68272DD2"), use "To be confirmed" instead
-    - Use "Bed type assigned at check-in" for bed_type if not specified
-    - For breakfast_included, use "Yes", "No", or "Not specified"
-    - Leave hotel_address and hotel_contact blank if not in document
-    - Extract all guest names if multiple are present
-    - Calculate num_nights from check-in and check-out dates if not explicitly stated
-    - For additional_information, extract important details as an array of strings including:
-      * Check-in/Check-out policies and specific timings
-      * Mandatory fees (deposits, destination fees, resort fees, etc.)
-      * Optional services and their costs (parking, breakfast, etc.)
-      * Age requirements and restrictions
-      * Pet policies and fees
-      * Special booking conditions and policies
-      * Important notes about the property or booking
-      * Any other relevant information guests should know
-    - Exclude generic boilerplate text and agent disclaimers
-    - Format each item as a clear, concise bullet point
-    - Return only valid JSON, no additional text
-
-    Text to extract from:
-    """ + text
-
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0
-        )
+        response = client.chat.completions.create(**voucher_request_params(text))
         
-        result = response.choices[0].message.content.strip()
+        result = response.choices[0].message.content
         
-        # Clean up the response to ensure it's valid JSON
-        if result.startswith("```json"):
-            result = result[7:]
-        if result.endswith("```"):
-            result = result[:-3]
-        
-        return json.loads(result)
+        voucher_data = parse_json_response(result)
+        store_cached_json(cache_key, voucher_data)
+        return voucher_data
         
     except json.JSONDecodeError as e:
         st.error(f"Failed to parse JSON from OpenAI response: {e}")
@@ -147,39 +552,237 @@ def extract_voucher_data(text):
         st.error(f"Error calling OpenAI API: {e}")
         return None
 
+async def request_voucher_data_async(texts, api_key):
+    """Send one extraction request per text concurrently, bounded by OPENAI_CONCURRENCY
+    
+    Returns a list aligned with texts holding parsed data or the raised exception.
+    """
+    import openai
+    
+    client = openai.AsyncOpenAI(api_key=api_key, max_retries=OPENAI_MAX_RETRIES)
+    semaphore = asyncio.Semaphore(OPENAI_CONCURRENCY)
+    
+    async def request_one(text):
+        async with semaphore:
+            response = await client.chat.completions.create(**voucher_request_params(text))
+        return parse_json_response(response.choices[0].message.content)
+    
+    try:
+        return await asyncio.gather(
+            *(request_one(text) for text in texts), return_exceptions=True
+        )
+    finally:
+        await client.close()
+
+def extract_voucher_data_concurrently(texts, api_key):
+    """Extract structured data for each text with concurrent OpenAI requests"""
+    responses = asyncio.run(request_voucher_data_async(texts, api_key))
+    
+    results = []
+    for text, response in zip(texts, responses):
+        if isinstance(response, Exception):
+            st.error(f"Error calling OpenAI API: {response}")
+            results.append(None)
+            continue
+        store_cached_json(voucher_cache_key(text), response)
+        results.append(response)
+    return results
+
+def split_into_batches(indices, texts):
+    """Group voucher indices into batches of at most MAX_BATCH_VOUCHERS vouchers
+    whose texts stay under MAX_BATCH_INPUT_TOKENS"""
+    max_chars = MAX_BATCH_INPUT_TOKENS * CHARS_PER_TOKEN
+    batches = []
+    current, current_chars = [], 0
+    for i in indices:
+        if current and (
+            len(current) >= MAX_BATCH_VOUCHERS or current_chars + len(texts[i]) > max_chars
+        ):
+            batches.append(current)
+            current, current_chars = [], 0
+        current.append(i)
+        current_chars += len(texts[i])
+    if current:
+        batches.append(current)
+    return batches
+
+def extract_voucher_data_batch(texts):
+    """Extract structured data for several vouchers with one OpenAI call per batch
+    
+    Returns a list aligned with texts; entries are None where extraction failed.
+    """
+    results = [load_cached_json(voucher_cache_key(text)) for text in texts]
+    pending = [i for i, data in enumerate(results) if data is None]
+    if not pending:
+        return results
+    
+    if len(pending) == 1:
+        results[pending[0]] = extract_voucher_data(texts[pending[0]])
+        return results
+    
+    client, api_key = get_openai_client()
+    if not client:
+        st.error("OpenAI API key not found. Please check your configuration.")
+        return results
+    
+    if not BATCH_PROMPTING:
+        extracted = extract_voucher_data_concurrently([texts[i] for i in pending], api_key)
+        for i, voucher_data in zip(pending, extracted):
+            results[i] = voucher_data
+        return results
+    
+    fallback = []
+    for batch in split_into_batches(pending, texts):
+        user_content = "\n---\n".join(
+            f"Voucher {n}:\n{texts[i]}" for n, i in enumerate(batch, start=1)
+        )
+        
+        try:
+            response = client.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=[
+                    {"role": "system", "content": BATCH_SYSTEM_PROMPT},
+                    {"role": "user", "content": user_content}
+                ],
+                response_format={
+                    "type": "json_schema",
+                    "json_schema": {
+                        "name": "voucher_batch",
+                        "schema": VOUCHER_BATCH_SCHEMA,
+                        "strict": True
+                    }
+                },
+                temperature=0
+            )
+            choice = response.choices[0]
+            if choice.finish_reason == "length":
+                raise ValueError("response was truncated at the output token limit")
+            vouchers = parse_json_response(choice.message.content)["vouchers"]
+        except Exception as e:
+            st.warning(f"Batched extraction failed, extracting vouchers one by one: {e}")
+            vouchers = None
+        
+        # Fall back to one request per voucher if the batch can't be mapped back
+        if vouchers is None or [
+            voucher.get("voucher_number") for voucher in vouchers
+        ] != list(range(1, len(batch) + 1)):
+            if vouchers is not None:
+                st.warning("Batched extraction returned vouchers out of order, extracting them one by one.")
+            fallback.extend(batch)
+            continue
+        
+        for i, voucher_data in zip(batch, vouchers):
+            del voucher_data["voucher_number"]
+            store_cached_json(voucher_cache_key(texts[i]), voucher_data)
+            results[i] = voucher_data
+    
+    if fallback:
+        extracted = extract_voucher_data_concurrently([texts[i] for i in fallback], api_key)
+        for i, voucher_data in zip(fallback, extracted):
+            results[i] = voucher_data
+    
+    return results
+
+@functools.lru_cache(maxsize=8)
+def find_path(path):
+    """Cached existence check for the static paths checked on every rerun
+    
+    Raises FileNotFoundError for missing paths; exceptions aren't cached, so a
+    file added later is picked up on the next rerun.
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    return path
+
+def path_exists(path):
+    """Check whether path exists, caching only positive results"""
+    try:
+        find_path(path)
+        return True
+    except FileNotFoundError:
+        return False
+
 def sanitize_additional_info(items):
     """Clean additional information to avoid empty bullets"""
     if not items:
         return []
-    clean = []
-    for x in items:
-        if not isinstance(x, str):
-            continue
-        t = x.strip().strip("•").strip("-").strip()
-        if t:
-            clean.append(t)
-    return clean
+    cleaned = (BULLET_RE.sub('', x) for x in items if isinstance(x, str))
+    return [t for t in cleaned if t]
 
-def generate_pdf_voucher(voucher_data):
-    """Generate standardized PDF voucher using HTML template"""
-    
-    # Load HTML template
-    template_path = os.path.join(os.path.dirname(__file__), 'templates', 'voucher_template.html')
+@st.cache_resource
+def get_voucher_template():
+    """Load and compile the voucher HTML template once per process"""
+    env = Environment(loader=FileSystemLoader(TEMPLATES_DIR), auto_reload=False, autoescape=True)
+    return env.get_template(TEMPLATE_NAME)
+
+@st.cache_resource
+def load_logo_data_uri():
+    """Embed logo.png as a data URI so WeasyPrint never fetches it from disk while rendering
     
+    Raises FileNotFoundError when the logo is missing; exceptions aren't cached,
+    so a logo added later is picked up on the next generation.
+    """
+    with open(LOGO_PATH, 'rb') as f:
+        return 'data:image/png;base64,' + base64.b64encode(f.read()).decode('ascii')
+
+def get_logo_data_uri():
+    """Get the logo as a data URI, or None if logo.png isn't present"""
     try:
-        with open(template_path, 'r', encoding='utf-8') as f:
-            template_content = f.read()
+        return load_logo_data_uri()
     except FileNotFoundError:
-        st.error("Template file not found. Please ensure templates/voucher_template.html exists.")
         return None
+
+@st.cache_resource
+def get_font_config():
+    """Create one WeasyPrint font configuration so system fonts are loaded only once"""
+    from weasyprint.text.fonts import FontConfiguration
     
-    # Check if logo exists
-    logo_path = os.path.join(os.path.dirname(__file__), 'logo.png')
-    logo_exists = os.path.exists(logo_path)
+    return FontConfiguration()
+
+@st.cache_resource
+def get_voucher_stylesheets():
+    """Parse the voucher print stylesheet once per process"""
+    import weasyprint
+    
+    return [weasyprint.CSS(
+        filename=os.path.join(TEMPLATES_DIR, STYLESHEET_NAME),
+        font_config=get_font_config()
+    )]
+
+def remove_file(path):
+    """Delete a file if it still exists"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def voucher_url_fetcher(url):
+    """Only resolve inline data: URIs (the embedded logo); refuse file and network URLs"""
+    import weasyprint
+    
+    if not url.startswith('data:'):
+        raise ValueError(f"Refusing to fetch {url}")
+    return weasyprint.default_url_fetcher(url)
+
+def generate_pdf_voucher(voucher_data):
+    """Generate standardized PDF voucher using HTML template
+    
+    Returns the path of the generated PDF file, or None on failure.
+    """
+    import weasyprint
+    
+    # Load HTML template and stylesheet
+    try:
+        template = get_voucher_template()
+        stylesheets = get_voucher_stylesheets()
+    except (TemplateNotFound, OSError):
+        st.error(f"Template files not found. Please ensure templates/{TEMPLATE_NAME} and templates/{STYLESHEET_NAME} exist.")
+        return None
     
     # Prepare template data
     template_data = voucher_data.copy()
-    template_data['logo_path'] = logo_path if logo_exists else None
+    template_data['logo_path'] = get_logo_data_uri()
+    template_data['voucher_metadata'] = encode_voucher_metadata(voucher_data)
     
     # Sanitize additional information to avoid empty bullets
     if 'additional_information' in template_data:
@@ -188,84 +791,120 @@ def generate_pdf_voucher(voucher_data):
         )
     
     # Render HTML
-    template = Template(template_content)
     html_content = template.render(**template_data)
+    html_content = STYLESHEET_LINK_RE.sub('', html_content)
     
-    # Convert HTML to PDF with proper base URL
+    # Convert HTML to PDF with proper base URL, writing straight to a temp file;
+    # the caller deletes it once the download button has read it
+    pdf_path = None
     try:
-        pdf_bytes = weasyprint.HTML(
-            string=html_content, 
-            base_url=os.path.dirname(os.path.abspath(__file__))
-        ).write_pdf()
-        return pdf_bytes
+        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp:
+            pdf_path = tmp.name
+        with PDF_RENDER_LOCK:
+            document = weasyprint.HTML(
+                string=html_content, 
+                base_url=BASE_DIR,
+                url_fetcher=voucher_url_fetcher
+            ).render(stylesheets=stylesheets, font_config=get_font_config())
+            document.write_pdf(target=pdf_path)
+        return pdf_path
     except Exception as e:
+        # Don't leave a partial PDF with guest data behind
+        if pdf_path:
+            remove_file(pdf_path)
         st.error(f"Error generating PDF: {e}")
         return None
 
 def main():
     st.title("Hotel Voucher Standardizer")
-    st.write("Upload a hotel voucher PDF to extract fields and generate a standardized voucher.")
+    st.write("Upload one or more hotel voucher PDFs to extract fields and generate standardized vouchers.")
     
     # File uploader
-    uploaded_file = st.file_uploader("Choose a PDF file", type="pdf")
+    uploaded_files = st.file_uploader("Choose PDF files", type="pdf", accept_multiple_files=True)
     
-    if uploaded_file is not None:
-        st.success(f"Uploaded: {uploaded_file.name}")
+    if uploaded_files:
+        st.success(f"Uploaded: {', '.join(f.name for f in uploaded_files)}")
         
         # Extract text button
         if st.button("Extract Text and Fields"):
             with st.spinner("Extracting text from PDF..."):
                 # Extract text
-                extracted_text = extract_text_from_pdf(uploaded_file)
-                
-                if extracted_text:
-                    st.subheader("Raw Extracted Text")
-                    st.text_area("Extracted Text", extracted_text, height=200)
-                    
-                    # Store in session state
-                    st.session_state.extracted_text = extracted_text
-                    
+                names, texts, results = [], [], []
+                for uploaded_file in uploaded_files:
+                    extracted_text, voucher_data = extract_text_from_pdf(uploaded_file)
+                    if extracted_text:
+                        names.append(uploaded_file.name)
+                        texts.append(extracted_text)
+                        results.append(voucher_data)
+                    else:
+                        st.error(f"No text could be extracted from {uploaded_file.name}.")
+            
+            if texts:
+                # Standardized vouchers already carry their fields; only send the rest to AI
+                pending = [i for i, voucher_data in enumerate(results) if voucher_data is None]
+                if pending:
                     with st.spinner("Extracting structured data with AI..."):
-                        # Extract structured data
-                        voucher_data = extract_voucher_data(extracted_text)
+                        # Extract structured data for all vouchers in as few requests as possible
+                        extracted = extract_voucher_data_batch([texts[i] for i in pending])
+                    for i, voucher_data in zip(pending, extracted):
+                        results[i] = voucher_data
+                
+                # Store in session state
+                st.session_state.vouchers = [
+                    {"name": name, "extracted_text": text, "voucher_data": voucher_data}
+                    for name, text, voucher_data in zip(names, texts, results)
+                ]
+                
+                tabs = st.tabs(names)
+                for index, (tab, voucher) in enumerate(zip(tabs, st.session_state.vouchers)):
+                    with tab:
+                        st.subheader("Raw Extracted Text")
+                        st.text_area(
+                            "Extracted Text", voucher["extracted_text"], height=200,
+                            key=f"extracted_text_{index}"
+                        )
                         
-                        if voucher_data:
+                        if voucher["voucher_data"]:
                             st.subheader("Extracted Fields (JSON)")
-                            st.json(voucher_data)
-                            
-                            # Store in session state
-                            st.session_state.voucher_data = voucher_data
+                            st.json(voucher["voucher_data"])
                         else:
                             st.error("Failed to extract structured data.")
-                else:
-                    st.error("No text could be extracted from the PDF.")
     
     # Generate PDF section
-    if hasattr(st.session_state, 'voucher_data') and st.session_state.voucher_data:
+    vouchers = [v for v in st.session_state.get('vouchers', []) if v["voucher_data"]]
+    if vouchers:
         st.divider()
         st.subheader("Generate Standardized Voucher")
         
-        if st.button("Generate PDF Voucher"):
-            with st.spinner("Generating standardized PDF voucher..."):
-                pdf_bytes = generate_pdf_voucher(st.session_state.voucher_data)
-                
-                if pdf_bytes:
-                    # Store PDF in session state
-                    st.session_state.generated_pdf = pdf_bytes
-                    st.success("PDF voucher generated successfully!")
-                    
-                    # Download button
-                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    filename = f"standardized_voucher_{timestamp}.pdf"
-                    
-                    st.download_button(
-                        label="Download Standardized Voucher",
-                        data=pdf_bytes,
-                        file_name=filename,
-                        mime="application/pdf"
-                    )
-                else:
-                    st.error("Failed to generate PDF voucher.")
+        tabs = st.tabs([v["name"] for v in vouchers])
+        for index, (tab, voucher) in enumerate(zip(tabs, vouchers)):
+            with tab:
+                if st.button("Generate PDF Voucher", key=f"generate_{index}"):
+                    with st.spinner("Generating standardized PDF voucher..."):
+                        pdf_path = generate_pdf_voucher(voucher["voucher_data"])
+                        
+                        if pdf_path:
+                            st.success("PDF voucher generated successfully!")
+                            
+                            # Download button
+                            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                            filename = f"standardized_voucher_{timestamp}.pdf"
+                            
+                            # The download button copies the file into Streamlit's media
+                            # store, so the temp file (with guest data) can go right away
+                            try:
+                                with open(pdf_path, 'rb') as pdf_file:
+                                    st.download_button(
+                                        label="Download Standardized Voucher",
+                                        data=pdf_file,
+                                        file_name=filename,
+                                        mime="application/pdf",
+                                        key=f"download_{index}"
+                                    )
+                            finally:
+                                remove_file(pdf_path)
+                        else:
+                            st.error("Failed to generate PDF voucher.")
     
     # Sidebar with info
     st.sidebar.header("About")
@@ -281,7 +920,7 @@ def main():
     ✅ **Additional information** capture from source vouchers  
     
     **How to use:**
-    1. Upload your hotel voucher PDF
+    1. Upload one or more hotel voucher PDFs
     2. Click "Extract Text and Fields"  
     3. Review the extracted information
     4. Generate and download standardized voucher
@@ -291,18 +930,19 @@ def main():
     st.sidebar.header("System Status")
     
     # Check API key
-    client, api_key = get_openai_client()
+    api_key = get_openai_api_key()
     api_key_status = "✅ Ready" if api_key else "❌ Missing"
     st.sidebar.write(f"AI Extraction: {api_key_status}")
     
     # Check logo
-    logo_path = os.path.join(os.path.dirname(__file__), 'logo.png')
-    logo_status = "✅ Found" if os.path.exists(logo_path) else "⚠️ Add logo.png for branding"
+    logo_status = "✅ Found" if path_exists(LOGO_PATH) else "⚠️ Add logo.png for branding"
     st.sidebar.write(f"Company Logo: {logo_status}")
     
     # Check template
-    template_path = os.path.join(os.path.dirname(__file__), 'templates', 'voucher_template.html')
-    template_status = "✅ Ready" if os.path.exists(template_path) else "❌ Missing"
+    template_ready = all(
+        path_exists(os.path.join(TEMPLATES_DIR, name)) for name in (TEMPLATE_NAME, STYLESHEET_NAME)
+    )
+    template_status = "✅ Ready" if template_ready else "❌ Missing"
     st.sidebar.write(f"PDF Generation: {template_status}")
     
     st.sidebar.markdown("---")